@@ -7,13 +7,15 @@
 import argparse
 import base64
 import binascii
+import concurrent.futures
 import glob
 import hashlib
 import itertools
-import math
+import json
 import os
 import struct
 import sys
+import threading
 import zlib
 
 
@@ -73,6 +75,22 @@ def parse_args() -> argparse.Namespace:
         help='Use developer-unit keys'
     )
 
+    parser.add_argument(
+        '--audit',
+        action='store_true',
+        help='Verify existing CIA files instead of converting, printing bad '
+             'files as JSON lines'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='count',
+        type=int,
+        default=os.cpu_count() or 1,
+        help='Number of files to verify at once with --audit '
+             '(default: number of CPUs)'
+    )
+
     # deprecated arguments; we want to print out a message on this
     # in the future we can probably use an `action` to handle this.
     parser.add_argument(
@@ -93,7 +111,7 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument(
         'game',
         nargs='+',
-        help='Game file to convert to CIA'
+        help='Game file to convert to CIA, or CIA file to verify with --audit'
     )
 
     # if no arguments are provided, display help message
@@ -112,6 +130,14 @@ try:
 except ImportError:
     pass  # this is handled later
 
+# resource is only on Unix-like systems, used for the memory usage report
+resource_found = False
+try:
+    import resource
+    resource_found = True
+except ImportError:
+    pass
+
 version = '4.21'
 
 args = parse_args()
@@ -203,6 +229,226 @@ def show_progress(val, maxval):
     sys.stdout.flush()
 
 
+# each thread gets one read buffer, reused for every file it handles so
+#   copying and hashing doesn't allocate per chunk
+# it only grows as large as needed, up to read_size
+buffers = threading.local()
+
+
+def get_buffer(size):
+    size = min(size, read_size)
+    if not hasattr(buffers, 'buffer') or len(buffers.buffer) < size:
+        buffers.buffer = memoryview(bytearray(size))
+    return buffers.buffer
+
+
+# read exactly len(view) bytes into view, returning the amount actually read
+def read_into(f, view):
+    total = 0
+    while total < len(view):
+        read = f.readinto(view[total:])
+        if not read:
+            break
+        total += read
+    return total
+
+
+# copy a content from the rom to the cia, updating its hash
+# offset is how much of the content was already written
+def copy_content(rom, cia, content_hash, size, offset=0):
+    left = size - offset
+    buf = get_buffer(left)
+    while left > 0:
+        read = read_into(rom, buf[:min(len(buf), left)])
+        if not read:
+            break
+        content_hash.update(buf[:read])
+        cia.write(buf[:read])
+        left -= read
+        show_progress(size - left, size)
+    print('')
+
+
+# peak memory usage of this process, or None if it can't be checked
+def peak_memory():
+    if not resource_found:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS gives bytes, everything else gives KiB
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak
+
+
+# align an offset in a CIA to the next 0x40 boundary
+def align(offset):
+    return (offset + 0x3F) & ~0x3F
+
+
+# verify a CIA written by this script
+# returns the path and a list of problems, which is empty if the file is good
+def audit_cia(path):
+    problems = []
+    try:
+        with open(path, 'rb') as cia:
+            header = cia.read(0x2020)
+            if len(header) < 0x2020:
+                problems.append('truncated CIA header')
+                return path, problems
+            header_size, __, __, cert_size, ticket_size, tmd_size, \
+                meta_size, content_size = struct.unpack('<IHHIIIIQ',
+                                                        header[0:0x20])
+            if header_size != 0x2020:
+                problems.append('invalid header size {:X}'.format(header_size))
+                return path, problems
+            content_index = header[0x20:0x2020]
+
+            # sections are laid out one after another, each aligned to 0x40
+            tmd_offset = align(align(align(header_size) + cert_size) +
+                               ticket_size)
+            content_offset = align(tmd_offset + tmd_size)
+            expected_size = align(content_offset + content_size) + meta_size
+            actual_size = os.fstat(cia.fileno()).st_size
+            if actual_size != expected_size:
+                problems.append('file size is {:X}, expected {:X}'.format(
+                    actual_size, expected_size))
+                if actual_size < expected_size:
+                    # the contents can't hash correctly, so skip reading them
+                    return path, problems
+
+            # tmd signature is expected to be RSA-2048 SHA-256, like the one
+            #   this script writes
+            cia.seek(tmd_offset)
+            tmd = cia.read(tmd_size)
+            if len(tmd) < 0xB04:
+                problems.append('truncated TMD')
+                return path, problems
+            if tmd[0:4] != b'\x00\x01\x00\x04':
+                problems.append('unsupported TMD signature type')
+                return path, problems
+            content_count = struct.unpack('>H', tmd[0x1DE:0x1E0])[0]
+            info_records = tmd[0x204:0xB04]
+            chunk_records = tmd[0xB04:0xB04 + (content_count * 0x30)]
+            if len(chunk_records) != content_count * 0x30:
+                problems.append('TMD too small for {} contents'.format(
+                    content_count))
+                return path, problems
+
+            if hashlib.sha256(info_records).digest() != tmd[0x1E4:0x204]:
+                problems.append('invalid content info records hash')
+            for info_num in range(0, 64):
+                info_record = info_records[info_num * 0x24:
+                                           (info_num + 1) * 0x24]
+                index_offset, command_count = struct.unpack(
+                    '>HH', info_record[0:4])
+                if command_count == 0:
+                    break
+                chunk_records_hash = hashlib.sha256(
+                    chunk_records[index_offset * 0x30:
+                                  (index_offset + command_count) * 0x30]
+                ).digest()
+                if chunk_records_hash != info_record[4:0x24]:
+                    problems.append('invalid content chunk records hash '
+                                    '(info record {})'.format(info_num))
+
+            # contents are stored back to back in chunk record order
+            cia.seek(content_offset)
+            total_size = 0
+            for chunk_num in range(0, content_count):
+                content_id, index, content_type, size, content_hash = \
+                    struct.unpack('>IHHQ32s', chunk_records[chunk_num * 0x30:
+                                                            (chunk_num + 1) *
+                                                            0x30])
+                if content_offset + total_size + size > actual_size:
+                    problems.append('content {:08X} extends past end of '
+                                    'file'.format(content_id))
+                    return path, problems
+                total_size += size
+                if not content_index[index >> 3] & (0x80 >> (index & 7)):
+                    problems.append('content index {} missing from CIA '
+                                    'header'.format(index))
+                if content_type & 1:
+                    problems.append('content {:08X} is encrypted, can\'t '
+                                    'verify'.format(content_id))
+                    cia.seek(size, 1)
+                    continue
+                hasher = hashlib.sha256()
+                buf = get_buffer(size)
+                left = size
+                while left > 0:
+                    read = read_into(cia, buf[:min(len(buf), left)])
+                    if not read:
+                        break
+                    hasher.update(buf[:read])
+                    left -= read
+                if left > 0 or hasher.digest() != content_hash:
+                    problems.append('invalid SHA-256 hash for content '
+                                    '{:08X}'.format(content_id))
+            if total_size != content_size:
+                problems.append('content size is {:X}, chunk records add up '
+                                'to {:X}'.format(content_size, total_size))
+    except OSError as e:
+        problems.append(str(e))
+    except struct.error as e:
+        # a damaged field can still leave data too short to parse
+        problems.append('can\'t parse CIA: {}'.format(e))
+    return path, problems
+
+
+# verify CIAs in parallel, printing a JSON line for each bad file
+# only a few files per job are queued at once, so huge globs stay cheap
+def audit_files(patterns, jobs):
+    audited_files = 0
+    bad_files = 0
+
+    def report(path, problems):
+        nonlocal audited_files, bad_files
+        audited_files += 1
+        if problems:
+            bad_files += 1
+            print(json.dumps({'file': path, 'problems': problems}))
+            sys.stdout.flush()
+
+    def iter_paths():
+        for arg in patterns:
+            found = False
+            for path in glob.iglob(arg):
+                found = True
+                yield path
+            if not found:
+                report(arg, ['file doesn\'t exist'])
+
+    paths = iter_paths()
+    pending = {}
+    jobs = max(jobs, 1)
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        while True:
+            for path in itertools.islice(paths, (jobs * 2) - len(pending)):
+                pending[executor.submit(audit_cia, path)] = path
+            if not pending:
+                break
+            done, __ = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # one unreadable file shouldn't end the whole sweep
+                    result = path, ['unexpected error: {}'.format(e)]
+                report(*result)
+
+    sys.stderr.write('Audited {} files, {} bad.\n'.format(audited_files,
+                                                          bad_files))
+    if args.verbose and peak_memory() is not None:
+        sys.stderr.write('Peak memory usage: {:.1f} MiB\n'.format(
+            peak_memory() / 0x100000))
+    return 1 if bad_files else 0
+
+
+if args.audit:
+    sys.exit(audit_files(args.game, args.jobs))
+
 total_files = 0
 processed_files = 0
 
@@ -403,13 +649,15 @@ for rom_file in files:
         # Game Executable fist-half ExtHeader
         print_v('\nVerifying ExtHeader...')
         rom.seek(game_cxi_offset + 0x200)
-        extheader = rom.read(0x400)
+        extheader = bytearray(0x400)
+        rom.readinto(extheader)
         if encrypted:
             print_v('Decrypting ExtHeader...')
             ctr_extheader = pyaes.Counter(initial_value=ctr_extheader_v)
             cipher_extheader = pyaes.AESModeOfOperationCTR(
                 key, counter=ctr_extheader)
-            extheader = cipher_extheader.decrypt(extheader)
+            # pyaes only accepts bytes
+            extheader = bytearray(cipher_extheader.decrypt(bytes(extheader)))
         extheader_hash = hashlib.sha256(extheader).digest()
         rom.seek(0x4160)
         ncch_extheader_hash = rom.read(0x20)
@@ -426,33 +674,31 @@ for rom_file in files:
 
         # patch ExtHeader to make an SD title
         print_v('Patching ExtHeader...')
-        extheader_list = list(extheader)
-        extheader_list[0xD] |= 2
-        extheader = bytes(extheader_list)
+        extheader[0xD] |= 2
         new_extheader_hash = hashlib.sha256(extheader).digest()
 
         # get dependency list for meta region
-        dependency_list = extheader[0x40:0x1C0]
+        dependency_list = bytes(extheader[0x40:0x1C0])
 
         # get save data size for tmd
-        save_size = extheader[0x1C0:0x1C4]
+        save_size = bytes(extheader[0x1C0:0x1C4])
 
         if encrypted:
             print_v('Re-encrypting ExtHeader...')
             ctr_extheader = pyaes.Counter(initial_value=ctr_extheader_v)
             cipher_extheader = pyaes.AESModeOfOperationCTR(
                 key, counter=ctr_extheader)
-            extheader = cipher_extheader.encrypt(extheader)
+            extheader = cipher_extheader.encrypt(bytes(extheader))
 
         # Game Executable NCCH Header
         print_v('\nReading NCCH Header of Game Executable...')
         rom.seek(game_cxi_offset)
-        ncch_header = list(rom.read(0x200))
-        ncch_header[0x160:0x180] = list(new_extheader_hash)
+        ncch_header = bytearray(0x200)
+        rom.readinto(ncch_header)
+        ncch_header[0x160:0x180] = new_extheader_hash
         if args.ignore_encryption == True:
             print_v('\nEncryption is ignored, setting ncchflag[7] to NoCrypto')
             ncch_header[0x18F] |= 0x4
-        ncch_header = bytes(ncch_header)
 
         # get icon from ExeFS
         print_v('Getting SMDH...')
@@ -511,20 +757,20 @@ for rom_file in files:
         with open(rom_file[2], 'wb') as cia:
             print_v('Writing CIA header...')
 
+            # SHA-256 hashes are patched in later
+            chunk_records = bytearray(content_count * 0x30)
+            record_offset = 0x30
             # 1st content: ID 0x, Index 0x0
-            chunk_records = struct.pack('>III', 0, 0, 0)
-            chunk_records += struct.pack(">I", game_cxi_size)
-            chunk_records += bytes(0x20)  # SHA-256 to be added later
+            struct.pack_into('>IIII', chunk_records, 0, 0, 0, 0, game_cxi_size)
             if manual_cfa_offset != 0:
                 # 2nd content: ID 0x1, Index 0x1
-                chunk_records += struct.pack('>III', 1, 0x10000, 0)
-                chunk_records += struct.pack('>I', manual_cfa_size)
-                chunk_records += bytes(0x20)  # SHA-256 to be added later
+                struct.pack_into('>IIII', chunk_records, record_offset,
+                                 1, 0x10000, 0, manual_cfa_size)
+                record_offset += 0x30
             if dlpchild_cfa_offset != 0:
                 # 3nd content: ID 0x2, Index 0x2
-                chunk_records += struct.pack('>III', 2, 0x20000, 0)
-                chunk_records += struct.pack('>I', dlpchild_cfa_size)
-                chunk_records += bytes(0x20)  # SHA-256 to be added later
+                struct.pack_into('>IIII', chunk_records, record_offset,
+                                 2, 0x20000, 0, dlpchild_cfa_size)
 
             content_size = game_cxi_size + manual_cfa_size + dlpchild_cfa_size
 
@@ -546,9 +792,6 @@ for rom_file in files:
                 chunk_records + tmd_padding
             )
 
-            # changing to list to update and hash later
-            chunk_records = list(chunk_records)
-
             # write content count in tmd
             cia.seek(0x2F9F)
             cia.write(bytes([content_count]))
@@ -565,30 +808,21 @@ for rom_file in files:
 
             # Game Executable CXI NCCH Header + first-half ExHeader
             cia.seek(0, 2)
-            game_cxi_hash = hashlib.sha256(ncch_header + extheader)
-            cia.write(ncch_header + extheader)
+            game_cxi_hash = hashlib.sha256(ncch_header)
+            game_cxi_hash.update(extheader)
+            cia.write(ncch_header)
+            cia.write(extheader)
 
             # Game Executable CXI second-half ExHeader + contents
             print('Writing Game Executable CXI...')
             rom.seek(game_cxi_offset + 0x200 + 0x400)
-            left = game_cxi_size - 0x200 - 0x400
-            tmpread = ''
-            for __ in itertools.repeat(
-                    0, int(math.floor((game_cxi_size / read_size)) + 1)):
-                to_read = min(read_size, left)
-                tmpread = rom.read(to_read)
-                game_cxi_hash.update(tmpread)
-                cia.write(tmpread)
-                left -= read_size
-                show_progress(game_cxi_size - left, game_cxi_size)
-                if left <= 0:
-                    print('')
-                    break
+            copy_content(rom, cia, game_cxi_hash, game_cxi_size,
+                         0x200 + 0x400)
             print_v('Game Executable CXI SHA-256 hash:')
             print_v('  {}'.format(game_cxi_hash.hexdigest().upper()))
             cia.seek(0x38D4)
             cia.write(game_cxi_hash.digest())
-            chunk_records[0x10:0x30] = list(game_cxi_hash.digest())
+            chunk_records[0x10:0x30] = game_cxi_hash.digest()
 
             cr_offset = 0
 
@@ -598,23 +832,12 @@ for rom_file in files:
                 print('Writing Manual CFA...')
                 manual_cfa_hash = hashlib.sha256()
                 rom.seek(manual_cfa_offset)
-                left = manual_cfa_size
-                for __ in itertools.repeat(
-                        0, int(math.floor((manual_cfa_size / read_size)) + 1)):
-                    to_read = min(read_size, left)
-                    tmpread = rom.read(to_read)
-                    manual_cfa_hash.update(tmpread)
-                    cia.write(tmpread)
-                    left -= read_size
-                    show_progress(manual_cfa_size - left, manual_cfa_size)
-                    if left <= 0:
-                        print('')
-                        break
+                copy_content(rom, cia, manual_cfa_hash, manual_cfa_size)
                 print_v('Manual CFA SHA-256 hash:')
                 print_v('  {}'.format(manual_cfa_hash.hexdigest().upper()))
                 cia.seek(0x3904)
                 cia.write(manual_cfa_hash.digest())
-                chunk_records[0x40:0x60] = list(manual_cfa_hash.digest())
+                chunk_records[0x40:0x60] = manual_cfa_hash.digest()
                 cr_offset += 0x30
 
             # Download Play child container CFA
@@ -623,31 +846,17 @@ for rom_file in files:
                 print('Writing Download Play child container CFA...')
                 dlpchild_cfa_hash = hashlib.sha256()
                 rom.seek(dlpchild_cfa_offset)
-                left = dlpchild_cfa_size
-                # i am so sorry
-                for __ in itertools.repeat(
-                        0, int(math.floor((dlpchild_cfa_size /
-                               read_size)) + 1)):
-                    to_read = min(read_size, left)
-                    tmpread = rom.read(to_read)
-                    dlpchild_cfa_hash.update(tmpread)
-                    cia.write(tmpread)
-                    left -= read_size
-                    show_progress(dlpchild_cfa_size - left, dlpchild_cfa_size)
-                    if left <= 0:
-                        print('')
-                        break
+                copy_content(rom, cia, dlpchild_cfa_hash, dlpchild_cfa_size)
                 print_v('- Download Play child container CFA SHA-256 hash:')
                 print_v('  {}'.format(dlpchild_cfa_hash.hexdigest().upper()))
                 cia.seek(0x3904 + cr_offset)
                 cia.write(dlpchild_cfa_hash.digest())
-                chunk_records[0x40 + cr_offset:0x60 + cr_offset] = list(
+                chunk_records[0x40 + cr_offset:0x60 + cr_offset] = \
                     dlpchild_cfa_hash.digest()
-                )
 
             # update final hashes
             print_v('\nUpdating hashes...')
-            chunk_records_hash = hashlib.sha256(bytes(chunk_records))
+            chunk_records_hash = hashlib.sha256(chunk_records)
             print_v('Content chunk records SHA-256 hash:')
             print_v('  {}'.format(chunk_records_hash.hexdigest().upper()))
             cia.seek(0x2FC7)
@@ -673,3 +882,5 @@ for rom_file in files:
 
 print("Done converting {} out of {} files.".format(processed_files,
                                                    total_files))
+if peak_memory() is not None:
+    print_v('Peak memory usage: {:.1f} MiB'.format(peak_memory() / 0x100000))
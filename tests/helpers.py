@@ -0,0 +1,61 @@
+import hashlib
+import os
+import struct
+import subprocess
+import sys
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))), '3dsconv', '3dsconv.py')
+mu = 0x200
+title_id = '0004000000123400'
+
+
+def run(*args, cwd, driver=None):
+    # driver is Python code run before the script, with its path in sys.argv
+    command = [sys.executable, SCRIPT]
+    if driver is not None:
+        command = [sys.executable, '-c', driver, SCRIPT]
+    return subprocess.run(command + list(args), cwd=cwd,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True)
+
+
+def make_cci(path, zerokey=False):
+    # CCI with a Game Executable CXI and a Manual CFA, decrypted unless
+    #   zerokey is set
+    # returns the decrypted CCI
+    cxi_offset, cxi_size = 0x4000, mu * 40
+    cfa_offset, cfa_size = cxi_offset + cxi_size, mu * 3
+    cci = bytearray(os.urandom(cfa_offset + cfa_size))
+    cci[0:cxi_offset] = bytes(cxi_offset)
+    cci[0x100:0x104] = b'NCSD'
+    cci[0x108:0x110] = bytes.fromhex(title_id)[::-1]
+    cci[0x120:0x130] = struct.pack('<IIII', cxi_offset // mu, cxi_size // mu,
+                                   cfa_offset // mu, cfa_size // mu)
+    cci[cxi_offset:cxi_offset + 0x200] = bytes(0x200)
+    cci[cxi_offset + 0x100:cxi_offset + 0x104] = b'NCCH'
+    cci[cxi_offset + 0x18F] = 0x1 if zerokey else 0x4  # zerokey or NoCrypto
+    extheader = bytes(cci[cxi_offset + 0x200:cxi_offset + 0x600])
+    cci[cxi_offset + 0x160:cxi_offset + 0x180] = \
+        hashlib.sha256(extheader).digest()
+    cci[cxi_offset + 0x1A0:cxi_offset + 0x1A4] = struct.pack('<I', 4)
+    exefs_offset = cxi_offset + (4 * mu)
+    cci[exefs_offset:exefs_offset + 0x10] = \
+        b'icon\0\0\0\0' + struct.pack('<II', 0, 0x36C0)
+
+    encrypted = bytearray(cci)
+    if zerokey:
+        import pyaes
+
+        def encrypt(offset, size, section):
+            counter = pyaes.Counter(
+                initial_value=int(title_id + section + '00000000000000', 16))
+            cipher = pyaes.AESModeOfOperationCTR(bytes(0x10), counter=counter)
+            encrypted[offset:offset + size] = cipher.encrypt(
+                bytes(cci[offset:offset + size]))
+
+        encrypt(cxi_offset + 0x200, 0x400, '01')  # ExHeader
+        encrypt(exefs_offset, 0x200 + 0x36C0, '02')  # ExeFS with icon
+    with open(path, 'wb') as f:
+        f.write(encrypted)
+    return bytes(cci)
@@ -0,0 +1,84 @@
+import json
+import struct
+
+import pytest
+
+from helpers import make_cci, run
+
+@pytest.fixture
+def cia(tmp_path):
+    make_cci(str(tmp_path / 'game.3ds'))
+    result = run('-o', 'out', 'game.3ds', cwd=str(tmp_path))
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(str(tmp_path / 'out' / 'game.cia'), 'rb') as f:
+        return f.read()
+
+
+def audit(tmp_path, files):
+    for name, data in files.items():
+        with open(str(tmp_path / name), 'wb') as f:
+            f.write(data)
+    result = run('--audit', '-j', '2', *sorted(files), cwd=str(tmp_path))
+    reports = {}
+    for line in result.stdout.splitlines():
+        report = json.loads(line)
+        reports[report['file']] = report['problems']
+    return result, reports
+
+
+def test_good_cia(tmp_path, cia):
+    result, reports = audit(tmp_path, {'good.cia': cia})
+    assert result.returncode == 0
+    assert reports == {}
+    assert 'Audited 1 files, 0 bad.' in result.stderr
+
+
+# 0x100 is too short to hold the content count, 0x300 ends in the middle of
+#   the content info records
+@pytest.mark.parametrize('tmd_size', [0x100, 0x300])
+def test_truncated_tmd(tmp_path, cia, tmd_size):
+    bad = bytearray(cia)
+    bad[0x10:0x14] = struct.pack('<I', tmd_size)
+    result, reports = audit(tmp_path, {'a_bad.cia': bytes(bad),
+                                       'b_good.cia': cia})
+    assert result.returncode == 1
+    assert 'Traceback' not in result.stderr
+    assert 'truncated TMD' in reports['a_bad.cia']
+    assert 'b_good.cia' not in reports
+    assert 'Audited 2 files, 1 bad.' in result.stderr
+
+
+def test_interrupted_write(tmp_path, cia):
+    # cut off in the middle of the Game Executable CXI
+    result, reports = audit(tmp_path, {'bad.cia': cia[:0x4900]})
+    assert result.returncode == 1
+    assert reports['bad.cia'] == [
+        'file size is 4900, expected {:X}'.format(len(cia))]
+
+
+def test_empty_file(tmp_path, cia):
+    result, reports = audit(tmp_path, {'bad.cia': b''})
+    assert result.returncode == 1
+    assert reports['bad.cia'] == ['truncated CIA header']
+
+
+def test_huge_content_size(tmp_path, cia):
+    # encrypted content with a size that can't be seeked past
+    bad = bytearray(cia)
+    bad[0x38CA:0x38D4] = struct.pack('>HQ', 1, 1 << 63)
+    result, reports = audit(tmp_path, {'a_bad.cia': bytes(bad),
+                                       'b_good.cia': cia})
+    assert result.returncode == 1
+    assert 'Traceback' not in result.stderr
+    assert 'content 00000000 extends past end of file' in \
+        reports['a_bad.cia']
+    assert 'b_good.cia' not in reports
+    assert 'Audited 2 files, 1 bad.' in result.stderr
+
+
+def test_bad_content_hash(tmp_path, cia):
+    bad = bytearray(cia)
+    bad[0x4000] ^= 0xFF
+    result, reports = audit(tmp_path, {'bad.cia': bytes(bad)})
+    assert result.returncode == 1
+    assert reports['bad.cia'] == ['invalid SHA-256 hash for content 00000000']
@@ -0,0 +1,63 @@
+import os
+import struct
+
+import pytest
+
+from helpers import make_cci, run, title_id
+
+# the script only converts encrypted files once it finds a bootROM with the
+#   real Original NCCH key X, so accept the blank key in a blank bootROM
+STUB_KEY = '''
+import hashlib
+import runpy
+import sys
+
+real_md5 = hashlib.md5
+
+
+class StubKey:
+    def hexdigest(self):
+        return 'e35bf88330f4f1b2bb6fd5b870a679ca'
+
+
+def md5(data=b''):
+    if data == bytes(0x10):
+        return StubKey()
+    return real_md5(data)
+
+
+hashlib.md5 = md5
+sys.argv = sys.argv[1:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+'''
+
+
+def test_zerokey(tmp_path):
+    pyaes = pytest.importorskip('pyaes')
+    cci = make_cci(str(tmp_path / 'game.3ds'), zerokey=True)
+    with open(str(tmp_path / 'boot9_prot.bin'), 'wb') as f:
+        f.write(bytes(0x8000))
+    result = run('-o', 'out', 'game.3ds', cwd=str(tmp_path), driver=STUB_KEY)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert 'Traceback' not in result.stderr
+    assert 'Done converting 1 out of 1 files.' in result.stdout
+    with open(str(tmp_path / 'out' / 'game.cia'), 'rb') as f:
+        cia = f.read()
+
+    # ExHeader is patched to make an SD title, then re-encrypted
+    tmd_size = struct.unpack('<I', cia[0x10:0x14])[0]
+    content_offset = (0x2DC0 + tmd_size + 0x3F) & ~0x3F
+    counter = pyaes.Counter(
+        initial_value=int(title_id + '0100000000000000', 16))
+    cipher = pyaes.AESModeOfOperationCTR(bytes(0x10), counter=counter)
+    extheader = bytearray(cci[0x4200:0x4600])
+    extheader[0xD] |= 2
+    assert cipher.decrypt(
+        cia[content_offset + 0x200:content_offset + 0x600]) == extheader
+
+    # icon in the Meta region is decrypted
+    assert cia[-0x36C0:] == cci[0x4A00:0x4A00 + 0x36C0]
+
+    result = run('--audit', os.path.join('out', 'game.cia'),
+                 cwd=str(tmp_path))
+    assert result.returncode == 0, result.stdout + result.stderr